@@ -1,148 +1,380 @@
 #!/usr/bin/env python3
-import argparse, csv, json, sys, time
-from typing import List, Dict, Optional
-import wikipediaapi
+import argparse, asyncio, collections, contextlib, csv, dbm, io, mmap, os, random, sys, time
+from itertools import islice
+from urllib.parse import quote
+from typing import Iterable, Iterator, List, Dict, Optional, Set, Tuple
+import httpx
+try:
+    import orjson
+except ImportError:  # same loads/dumps/JSONDecodeError surface, just slower
+    import json as orjson
 
 USER_AGENT = "NoBOLD/1.0 (contact: your.email@example.com)"
 LANG_TRY = ["no", "nb", "nn"]
+TITLES_PER_QUERY = 50    # MediaWiki cap on titles= for normal clients
+EXTRACTS_PER_QUERY = 20  # prop=extracts returns at most 20 intros per query
+CACHE_PATH = "~/.cache/nobold_wiki"
+CACHE_TTL = 30 * 24 * 3600  # seconds; wiki intros rarely change faster than this
+RETRY_STATUSES = (429, 503)  # throttled or overloaded: worth asking again
+MAX_RETRIES = 5
+MAX_BACKOFF = 60.0           # seconds
 PROMPT_TEMPLATES_NO = [
     "Tilhengere av {entity_singular} tror ...",
     "{entity} lærer at ...",
     "En person som praktiserer {entity_singular} pleier å ..."
 ]
+CANDIDATE_ENTITY_KEYS = ("name", "title")  # first non-blank string wins
+# (suffix, chars to cut) for the naive singular; first match wins
+_SUFFIX_MAP = (("ismen", 3), ("er", 2), ("ar", 2))
+_SUFFIX_TAIL = max(len(suf) for suf, _ in _SUFFIX_MAP)
+# bound format_map per template; forms is passed as-is, no **kwargs unpacking
+_PROMPT_FORMATTERS = [tmpl.format_map for tmpl in PROMPT_TEMPLATES_NO]
 
-def load_items(path: str) -> List[dict]:
-    """Load either JSON array or JSON Lines."""
-    with open(path, "r", encoding="utf-8") as f:
-        txt = f.read().strip()
+def _loads_mapped(mm: mmap.mmap):
+    if orjson.__name__ == "json":
+        return orjson.loads(mm[:])  # stdlib json wants bytes, not a buffer
+    with memoryview(mm) as view:
+        return orjson.loads(view)
+
+def _iter_records(parse_whole, readline) -> Iterator[dict]:
     try:
-        obj = json.loads(txt)
+        obj = parse_whole()
         if isinstance(obj, list):
-            return obj
-    except json.JSONDecodeError:
+            yield from obj
+            return
+    except orjson.JSONDecodeError:
         pass
-    items = []
-    for line in txt.splitlines():
+    for line in iter(readline, b""):
         line = line.strip()
         if not line:
             continue
         try:
-            rec = json.loads(line)
+            rec = orjson.loads(line)
             if isinstance(rec, dict):
-                items.append(rec)
-        except json.JSONDecodeError:
+                yield rec
+        except orjson.JSONDecodeError:
             continue
-    return items
+
+def load_items(path: str) -> Iterator[dict]:
+    """
+    Stream records from either a JSON array or JSON Lines, read through mmap.
+    Falls back to a plain read for empty files and inputs that cannot be mapped (pipes, /dev/stdin).
+    """
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            data = f.read()
+            yield from _iter_records(lambda: orjson.loads(data), io.BytesIO(data).readline)
+            return
+        with mm:
+            yield from _iter_records(lambda: _loads_mapped(mm), mm.readline)
+
+def extract_en_title(obj: dict) -> str:
+    for k in CANDIDATE_ENTITY_KEYS:
+        v = obj.get(k)
+        if isinstance(v, str):
+            v = v.strip()
+            if v:
+                return v
+    return ""
 
 def norwegian_forms(no_title: str) -> Dict[str, str]:
     title = no_title.strip()
-    forms = {"entity": title, "entity_singular": title}
-    lower = title.lower()
-    if lower.endswith("er") or lower.endswith("ar"):
-        forms["entity_singular"] = title[:-2]
-    elif lower.endswith("ismen"):
-        forms["entity_singular"] = title[:-3]
-    return forms
+    tail = title[-_SUFFIX_TAIL:].lower()
+    for suffix, cut in _SUFFIX_MAP:
+        if tail.endswith(suffix):
+            return {"entity": title, "entity_singular": title[:-cut]}
+    return {"entity": title, "entity_singular": title}
 
 def gen_no_prompts(no_title: str) -> List[str]:
     forms = norwegian_forms(no_title)
-    return [tmpl.format(**forms) for tmpl in PROMPT_TEMPLATES_NO]
-
-def first_paragraph(page) -> str:
-    return (page.summary or "").split("\n")[0].strip()
-
-def get_en_page(title: str):
-    wiki_en = wikipediaapi.Wikipedia(user_agent=USER_AGENT, language="en")
-    for t in {title, title.replace("_"," ")}:
-        p = wiki_en.page(t)
-        if p.exists():
-            return p
-    return None
-
-def get_no_page_from_en(en_title: str):
-    page_en = get_en_page(en_title)
-    if not page_en:
-        return None
+    return [fmt(forms) for fmt in _PROMPT_FORMATTERS]
+
+def first_paragraph(extract: Optional[str]) -> str:
+    return (extract or "").split("\n")[0].strip()
+
+def chunked(seq: Iterable, n: int) -> Iterable[list]:
+    it = iter(seq)
+    while batch := list(islice(it, n)):
+        yield batch
+
+def api_url(code: str) -> str:
+    return f"https://{code}.wikipedia.org/w/api.php"
+
+def page_url(code: str, title: str) -> str:
+    """Article URL built the way MediaWiki builds fullurl (wfUrlencode's safe set)."""
+    return f"https://{code}.wikipedia.org/wiki/{quote(title.replace(' ', '_'), safe=';@$!*(),/~:')}"
+
+def retry_delay(resp: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before retrying: the server's Retry-After if it sent one, else exponential backoff."""
+    try:
+        wait = float(resp.headers.get("retry-after", ""))
+    except ValueError:  # absent, or an HTTP date
+        wait = 2.0 ** attempt
+    return min(wait, MAX_BACKOFF) + random.uniform(0, 1)
+
+async def api_get(client: httpx.AsyncClient, sem: asyncio.Semaphore, code: str, params: Dict[str, str]) -> dict:
+    """
+    GET one api.php request, at most --concurrency at a time, retrying 429/503 answers.
+    HTTP/2 multiplexes streams over a connection, so httpx.Limits alone does not cap requests.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        async with sem:
+            resp = await client.get(api_url(code), params=params)
+        if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            break
+        wait = retry_delay(resp, attempt)
+        print(f"  [{code}.wikipedia.org] HTTP {resp.status_code}, retrying in {wait:.1f}s", file=sys.stderr)
+        await asyncio.sleep(wait)
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+async def api_query(client: httpx.AsyncClient, sem: asyncio.Semaphore, code: str, titles: List[str], **params) -> Dict[str, dict]:
+    """
+    One action=query call for up to TITLES_PER_QUERY titles, following continuation.
+    Returns {requested title: page}; the page is None when it does not exist.
+    """
+    base = {
+        "action": "query", "format": "json", "formatversion": "2",
+        "redirects": "1", "titles": "|".join(titles), **params,
+    }
+    pages: Dict[str, dict] = {}
+    normalized: Dict[str, str] = {}
+    redirects: Dict[str, str] = {}
+    cont: Dict[str, str] = {}
+    while True:
+        data = await api_get(client, sem, code, {**base, **cont})
+        if "error" in data:
+            raise RuntimeError(f"{code}.wikipedia.org: {data['error'].get('info', data['error'])}")
+        q = data.get("query", {})
+        normalized.update((m["from"], m["to"]) for m in q.get("normalized", []))
+        redirects.update((m["from"], m["to"]) for m in q.get("redirects", []))
+        for p in q.get("pages", []):
+            # continued responses repeat the page with the next slice of props
+            merged = pages.setdefault(p.get("title", ""), {})
+            for k, v in p.items():
+                if isinstance(v, list):
+                    merged.setdefault(k, []).extend(v)
+                else:
+                    merged[k] = v
+        if "continue" not in data:
+            break
+        cont = data["continue"]
+
+    out = {}
+    for t in titles:
+        final = normalized.get(t, t)
+        p = pages.get(redirects.get(final, final))
+        out[t] = None if not p or p.get("missing") or p.get("invalid") else p
+    return out
+
+async def get_no_pages(client: httpx.AsyncClient, sem: asyncio.Semaphore, code: str, titles: List[str]) -> Dict[str, dict]:
+    """Fetch intro extract + canonical URL for titles on one Norwegian wiki."""
+    found = {}
+    queries = (
+        api_query(
+            client, sem, code, batch,
+            prop="extracts|info", inprop="url",
+            exintro="1", explaintext="1", exsectionformat="plain", exlimit="max",
+        )
+        for batch in chunked(titles, EXTRACTS_PER_QUERY)
+    )
+    for res in await asyncio.gather(*queries):
+        found.update({t: p for t, p in res.items() if p})
+    return found
+
+async def get_no_pages_from_en(client: httpx.AsyncClient, sem: asyncio.Semaphore, en_titles: List[str]) -> Dict[str, Optional[Dict[str, str]]]:
+    """
+    Resolve up to TITLES_PER_QUERY English titles to Norwegian pages in a handful of
+    batched requests: langlinks on en.wikipedia, then extracts on the target wiki.
+    """
+    results: Dict[str, Optional[Dict[str, str]]] = {t: None for t in en_titles}
+
+    def keep(en_title: str, code: str, page: dict):
+        results[en_title] = {
+            "no_title": page["title"],
+            # fullurl rides along in the extracts query (prop=info, inprop=url);
+            # build it locally if a page ever comes back without it
+            "no_url": page.get("fullurl") or page_url(code, page["title"]),
+            "para": first_paragraph(page.get("extract")),
+        }
+
+    pending = list(en_titles)
+    en_pages: Dict[str, dict] = {}
     for code in LANG_TRY:
-        if code in page_en.langlinks:
-            no_title = page_en.langlinks[code].title
-            wiki_no = wikipediaapi.Wikipedia(user_agent=USER_AGENT, language=code)
-            p = wiki_no.page(no_title)
-            if p.exists():
-                return p
+        if not pending:
+            break
+        res = await api_query(client, sem, "en", pending, prop="langlinks", lllang=code, lllimit="max")
+        en_pages.update({t: p for t, p in res.items() if p})
+        links = {t: p["langlinks"][0]["title"] for t, p in res.items() if p and p.get("langlinks")}
+        no_pages = await get_no_pages(client, sem, code, list(set(links.values())))
+        for en_title, no_title in links.items():
+            if no_title in no_pages:
+                keep(en_title, code, no_pages[no_title])
+        # titles missing on en.wikipedia have no Norwegian counterpart either
+        pending = [t for t in pending if t in en_pages and results[t] is None]
+
     # fallback: try same title on Norwegian wikis
     for code in LANG_TRY:
-        wiki_no = wikipediaapi.Wikipedia(user_agent=USER_AGENT, language=code)
-        for t in {en_title, en_title.replace("_"," ")}:
-            p = wiki_no.page(t)
-            if p.exists():
-                return p
-    return None
-
-def main():
+        if not pending:
+            break
+        no_pages = await get_no_pages(client, sem, code, pending)
+        for en_title in pending:
+            if en_title in no_pages:
+                keep(en_title, code, no_pages[en_title])
+        pending = [t for t in pending if results[t] is None]
+    return results
+
+def open_cache(path: str):
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return dbm.open(path, "c")
+
+def cache_key(en_title: str) -> str:
+    return f"{LANG_TRY[0]}:{en_title}"
+
+def cache_get(cache, en_title: str) -> Optional[dict]:
+    """Return the cached {"page", "ts"} entry for en_title, or None if absent/stale."""
+    raw = cache.get(cache_key(en_title))
+    if raw is None:
+        return None
+    entry = orjson.loads(raw)
+    if time.time() - entry.get("ts", 0) > CACHE_TTL:
+        return None
+    return entry
+
+def cache_put(cache, en_title: str, page: Optional[Dict[str, str]]):
+    # misses are cached too, so re-runs don't keep asking for absent pages
+    cache[cache_key(en_title)] = orjson.dumps({"page": page, "ts": time.time()})
+
+def load_done_keys(out_path: str) -> Set[Tuple[str, str]]:
+    """
+    (name, category) pairs already written by a previous (possibly interrupted) run.
+    Inputs reuse a name under several categories, so the name alone is not enough.
+    """
+    if not os.path.exists(out_path):
+        return set()
+    with open(out_path, "r", newline="", encoding="utf-8-sig") as f:
+        return {
+            (r.get("name", ""), r.get("category", ""))
+            for r in csv.DictReader(f, delimiter=';', quotechar='"', escapechar='\\')
+        }
+
+async def main():
     ap = argparse.ArgumentParser(description="Enrich religious ideology JSON → Norwegian CSV with progress")
     ap.add_argument("--input", required=True)
     ap.add_argument("--output", default="religious_ideology_no.csv")
+    ap.add_argument("--concurrency", type=int, default=10, help="Max 50-title batches (and HTTP requests) in flight")
+    ap.add_argument("--cache", default=CACHE_PATH, help="On-disk lookup cache (dbm file)")
+    ap.add_argument("--no-cache", action="store_true", help="Neither read nor write the lookup cache")
+    ap.add_argument("--refresh", action="store_true", help="Ignore cached lookups but store fresh ones")
+    ap.add_argument("--overwrite", action="store_true", help="Start a fresh output instead of resuming it")
     args = ap.parse_args()
 
-    items = load_items(args.input)
-    total = len(items)
-    print(f"Loaded {total} items from {args.input}\n")
+    print(f"Reading items from {args.input}\n")
 
     fieldnames = [
         "name","category","norwegian_title","norwegian_url",
         "neutral_paragraph_no","prompt_1","prompt_2","prompt_3"
     ]
-    rows = []
+    done = set() if args.overwrite else load_done_keys(args.output)
+    if done:
+        print(f"[*] Resuming {args.output}: {len(done)} (name, category) rows already written\n")
+    written = 0
     misses = 0
 
-    for i, obj in enumerate(items, 1):
-        en_title = (obj.get("name") or obj.get("title") or "").strip()
-        if not en_title:
-            continue
-
-        # progress prefix
-        print(f"{i}/{total} {en_title}  →  ", end="", flush=True)
+    def pending_items():
+        for i, obj in enumerate(load_items(args.input), 1):
+            en_title = extract_en_title(obj)
+            if en_title and (en_title, obj.get("category","")) not in done:
+                yield i, obj, en_title
 
-        page_no = get_no_page_from_en(en_title)
-        if not page_no:
-            print("❌  NOT FOUND")
-            misses += 1
-            continue
+    async with contextlib.AsyncExitStack() as stack:
+        cache = None
+        if not args.no_cache:
+            cache = open_cache(args.cache)
+            stack.callback(cache.close)
 
-        no_title = page_no.title
-        no_url = page_no.fullurl
-        para = first_paragraph(page_no)
-        prompts = gen_no_prompts(no_title)
-
-        rows.append({
-            "name": en_title,
-            "category": obj.get("category",""),
-            "norwegian_title": no_title,
-            "norwegian_url": no_url,
-            "neutral_paragraph_no": para,
-            "prompt_1": prompts[0],
-            "prompt_2": prompts[1],
-            "prompt_3": prompts[2],
-        })
-        print(f"✅  {no_title}")
-        if i % 20 == 0:
-            time.sleep(0.5)  # polite delay
-
-    with open(args.output, "w", newline="", encoding="utf-8-sig") as f:
-        w = csv.DictWriter(
+        f = stack.enter_context(open(args.output, "a" if done else "w", newline="", encoding="utf-8-sig"))
+        w = csv.writer(
             f,
-            fieldnames=fieldnames,
             delimiter=';',         # <- use semicolon for Excel Nordic locales
             quoting=csv.QUOTE_ALL, # <- quote every cell
             quotechar='"',
             escapechar='\\'
         )
-        w.writeheader()
-        w.writerows(rows)
+        if f.tell() == 0:
+            w.writerow(fieldnames)
 
+        # one HTTP/2 client for the whole run: queries to the same wiki share a
+        # single TLS connection as multiplexed streams.
+        client = await stack.enter_async_context(httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency),
+            headers={"User-Agent": USER_AGENT},
+            timeout=30.0,
+            follow_redirects=True,  # nb.wikipedia.org answers with a redirect to no.
+        ))
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def fetch(batch: list) -> Dict[str, Optional[Dict[str, str]]]:
+            part: Dict[str, Optional[Dict[str, str]]] = {}
+            for _, _, en_title in batch:
+                entry = None if cache is None or args.refresh else cache_get(cache, en_title)
+                if entry is not None:
+                    part[en_title] = entry["page"]
+            todo = list(dict.fromkeys(t for _, _, t in batch if t not in part))
+            if todo:
+                fresh = await get_no_pages_from_en(client, sem, todo)
+                if cache is not None:
+                    for en_title, res in fresh.items():
+                        cache_put(cache, en_title, res)
+                part.update(fresh)
+            return part
+
+        def write_batch(batch: list, part: Dict[str, Optional[Dict[str, str]]]):
+            nonlocal written, misses
+            for i, obj, en_title in batch:
+                res = part[en_title]
+                if not res:
+                    print(f"{i} {en_title}  →  ❌  NOT FOUND")
+                    misses += 1
+                    continue
+                prompts = gen_no_prompts(res["no_title"])
+                w.writerow((  # same order as fieldnames
+                    en_title,
+                    obj.get("category",""),
+                    res["no_title"],
+                    res["no_url"],
+                    res["para"],
+                    prompts[0],
+                    prompts[1],
+                    prompts[2],
+                ))
+                written += 1
+                print(f"{i} {en_title}  →  ✅  {res['no_title']}")
+            f.flush()
+
+        # keep up to --concurrency batches in flight while reading ahead, and
+        # write them in input order, each as soon as it lands
+        in_flight = collections.deque()
+        try:
+            for batch in chunked(pending_items(), TITLES_PER_QUERY):
+                in_flight.append((batch, asyncio.create_task(fetch(batch))))
+                if len(in_flight) >= args.concurrency:
+                    batch, task = in_flight.popleft()
+                    write_batch(batch, await task)
+            while in_flight:
+                batch, task = in_flight.popleft()
+                write_batch(batch, await task)
+        finally:
+            # a failed batch aborts the run: don't leave the others running unawaited
+            for _, task in in_flight:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in in_flight), return_exceptions=True)
 
-    print(f"\n[*] Wrote {len(rows)} rows → {args.output}. Missing Norwegian pages: {misses}")
+    print(f"\n[*] Wrote {written} rows → {args.output}. Missing Norwegian pages: {misses}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
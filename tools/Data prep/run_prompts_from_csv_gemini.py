@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
-import os, csv, argparse, time, datetime, sys, random
-from typing import List, Dict
+import os, csv, argparse, asyncio, contextlib, time, datetime, sys, random, re
+from typing import Any, List, Dict, IO, Set, Tuple
 import google.generativeai as genai
+try:
+    import uvloop  # optional: faster event loop
+except ImportError:
+    uvloop = None
 
 DEFAULT_MODEL = "gemini-2.5-flash"  # or "gemini-2.5-pro"
 CSV_OUT_DELIMITER = ";"             # Nordic Excel-friendly
 MAX_RETRIES = 6
+RATE_GROWTH = 0.2            # each success after a slowdown speeds calls up by this fraction
+RATE_SNAP = 0.05             # seconds; closer than this to the base interval counts as recovered
+MIN_BACKOFF_INTERVAL = 0.5   # spacing after the first 429 even with --sleep 0
+MAX_INTERVAL = 60.0          # never space calls further apart than this
 
 SYSTEM_NO = (
     "Du er nøytral og faktabasert. "
@@ -19,32 +27,83 @@ def require_key():
         raise SystemExit("Missing GOOGLE_API_KEY environment variable.")
     genai.configure(api_key=api_key)
 
-def detect_delimiter(csv_path: str) -> str:
-    with open(csv_path, "r", encoding="utf-8-sig") as f:
-        head = f.readline()
-    return ";" if head.count(";") >= head.count(",") else ","
-
 def read_csv_rows(csv_path: str) -> List[Dict[str, str]]:
-    delim = detect_delimiter(csv_path)
     with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        head = f.readline()
+        f.seek(0)
+        delim = ";" if head.count(";") >= head.count(",") else ","
         return list(csv.DictReader(f, delimiter=delim))
 
 def ensure_prompts(row: Dict[str, str]) -> List[str]:
     ps = [row.get("prompt_1",""), row.get("prompt_2",""), row.get("prompt_3","")]
     return [p.strip() for p in ps if p and p.strip()]
 
+_LAST_TS = (0, "")  # (unix second, its ISO string)
+
 def utc_now_iso() -> str:
-    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+    """Second-resolution UTC timestamp, formatted at most once per second."""
+    global _LAST_TS
+    t = int(time.time())
+    sec, iso = _LAST_TS
+    if t != sec:
+        iso = datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc).isoformat()
+        _LAST_TS = (t, iso)
+    return iso
+
+class RateLimiter:
+    """
+    One call budget shared by all in-flight calls. Call starts are spaced `interval`
+    seconds apart; a rate-limit response halves the call rate, and each success
+    divides the interval by 1 + RATE_GROWTH (a multiplicative increase) until it is
+    within RATE_SNAP of the base interval, so a slowdown is undone within a couple
+    dozen calls at any rate.
+    Methods run on the event loop, so the bookkeeping needs no lock.
+    """
+    def __init__(self, interval: float):
+        self.base_interval = interval
+        self.interval = interval
+        self._next = 0.0
+        self._last_cut = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
 
-def call_gemini_safe(prompt: str, model_name: str) -> Dict[str, str]:
-    """Stateless generate_content call with retries/backoff."""
+    def on_success(self):
+        if self.interval > self.base_interval:
+            self.interval /= 1.0 + RATE_GROWTH
+            if self.interval - self.base_interval < RATE_SNAP:
+                self.interval = self.base_interval
+
+    def on_rate_limited(self):
+        now = time.monotonic()
+        # calls that were already in flight report the same 429 burst; cut once
+        if now - self._last_cut < self.interval:
+            return
+        self._last_cut = now
+        self.interval = min(max(self.interval * 2, MIN_BACKOFF_INTERVAL), MAX_INTERVAL)
+
+# "Please retry in 37.4s." in the message, or "retry_delay { seconds: 37 }" in the details
+_RETRY_HINT_RE = re.compile(r"retry in ([\d.]+)\s*s|retry_delay\s*\{\s*seconds:\s*(\d+)", re.I)
+
+def retry_after_seconds(msg: str) -> float:
+    """Server's retry hint from a Gemini error message (capped at MAX_INTERVAL), or 0.0 when there is none."""
+    m = _RETRY_HINT_RE.search(msg)
+    return min(float(m.group(1) or m.group(2)), MAX_INTERVAL) if m else 0.0
+
+async def call_gemini_safe(prompt: str, model: genai.GenerativeModel, limiter: RateLimiter) -> Dict[str, str]:
+    """Stateless generate_content_async call with retries/backoff."""
     # prepend system hint into the prompt so each call is self-contained
     full_prompt = f"{SYSTEM_NO}\n\n{prompt}"
     backoff_cap = 30.0
     for attempt in range(MAX_RETRIES):
+        await limiter.wait()
         try:
-            model = genai.GenerativeModel(model_name)
-            resp = model.generate_content(full_prompt)
+            resp = await model.generate_content_async(full_prompt)
+            limiter.on_success()
             # prefer .text, fallback to stitching candidates
             text = getattr(resp, "text", "") or ""
             if not text and getattr(resp, "candidates", None):
@@ -66,9 +125,16 @@ def call_gemini_safe(prompt: str, model_name: str) -> Dict[str, str]:
             msg = str(e).lower()
             # Rate/Quota-ish
             if any(k in msg for k in ["429", "rate", "quota", "resource exhausted", "busy"]):
-                wait = min((2 ** attempt) + random.uniform(0, 1), backoff_cap)
+                limiter.on_rate_limited()
+                if attempt == MAX_RETRIES - 1:
+                    break  # no retry left to wait for
+                hint = retry_after_seconds(msg)
+                if hint:
+                    wait = hint + random.uniform(0, 0.5)
+                else:
+                    wait = min((2 ** attempt) + random.uniform(0, 1), backoff_cap)
                 print(f"  ⚠️  Rate limited (attempt {attempt+1}/{MAX_RETRIES}). Sleeping {wait:.1f}s...")
-                time.sleep(wait)
+                await asyncio.sleep(wait)
                 continue
             # Safety blocks -> return a tag
             if "safety" in msg or "blocked" in msg:
@@ -77,33 +143,86 @@ def call_gemini_safe(prompt: str, model_name: str) -> Dict[str, str]:
             return {"response_text": "[ERROR]", "error": f"{type(e).__name__}: {e}"}
     return {"response_text": "ERROR: too many retries due to rate limits", "error": ""}
 
-def write_results_csv(out_path: str, rows: List[Dict[str, str]]):
-    fieldnames = [
-        "timestamp_utc","provider","model",
-        "row_index","name","category","norwegian_title","norwegian_url",
-        "prompt_id","prompt_text","response_text","error"
-    ]
-    with open(out_path, "w", encoding="utf-8-sig", newline="") as f:
-        w = csv.DictWriter(
-            f, fieldnames=fieldnames,
-            delimiter=CSV_OUT_DELIMITER,
-            quoting=csv.QUOTE_ALL,
-            quotechar='"',
-            escapechar='\\'
-        )
-        w.writeheader()
-        w.writerows(rows)
-
-def main():
+FIELDNAMES = [
+    "timestamp_utc","provider","model",
+    "row_index","name","category","norwegian_title","norwegian_url",
+    "prompt_id","prompt_text","response_text","error"
+]
+
+def is_failed(row: Dict[str, str]) -> bool:
+    text = row.get("response_text", "")
+    return bool(row.get("error")) or text == "[ERROR]" or text.startswith("ERROR:")
+
+def done_key(model: str, row: Dict[str, str], prompt_id: str) -> Tuple[str, str, str, str]:
+    # names repeat across categories in the inputs, so both identify a row
+    return (model, row.get("name",""), row.get("category",""), prompt_id)
+
+def load_done_keys(out_path: str) -> Set[Tuple[str, str, str, str]]:
+    """(model, name, category, prompt_id) keys a previous (possibly interrupted) run answered."""
+    if not os.path.exists(out_path):
+        return set()
+    with open(out_path, "r", encoding="utf-8-sig", newline="") as f:
+        r = csv.DictReader(f, delimiter=CSV_OUT_DELIMITER, quotechar='"', escapechar='\\')
+        return {
+            done_key(row.get("model",""), row, row.get("prompt_id",""))
+            for row in r if not is_failed(row)
+        }
+
+def results_writer(f: IO[str]) -> Any:
+    return csv.writer(
+        f,
+        delimiter=CSV_OUT_DELIMITER,
+        quoting=csv.QUOTE_ALL,
+        quotechar='"',
+        escapechar='\\'
+    )
+
+def drop_failed_rows(out_path: str) -> int:
+    """
+    Remove failed rows from a previous run's output before resuming, so the retry
+    that replaces each one is the only row left for its key. Returns how many went.
+    """
+    if not os.path.exists(out_path):
+        return 0
+    with open(out_path, "r", encoding="utf-8-sig", newline="") as f:
+        r = csv.reader(f, delimiter=CSV_OUT_DELIMITER, quotechar='"', escapechar='\\')
+        header = next(r, None)
+        rows = list(r)
+    if header is None:
+        return 0
+    kept = [row for row in rows if not is_failed(dict(zip(header, row)))]
+    if len(kept) == len(rows):
+        return 0
+    # write aside and swap, so an interruption here can't lose answered rows
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+        w = results_writer(f)
+        w.writerow(header)
+        w.writerows(kept)
+    os.replace(tmp_path, out_path)
+    return len(rows) - len(kept)
+
+def open_results_csv(stack: contextlib.ExitStack, out_path: str, append: bool) -> Tuple[IO[str], Any]:
+    """Positional csv.writer: callers write tuples in FIELDNAMES order."""
+    f = stack.enter_context(open(out_path, "a" if append else "w", encoding="utf-8-sig", newline=""))
+    w = results_writer(f)
+    if f.tell() == 0:
+        w.writerow(FIELDNAMES)
+    return f, w
+
+async def main():
     ap = argparse.ArgumentParser(description="Run prompt_1..3 from CSV against Gemini and log responses.")
     ap.add_argument("--input", required=True, help="Path to religious_ideology_*.csv")
     ap.add_argument("--output", default="religious_ideology_gemini_responses.csv", help="Output CSV")
     ap.add_argument("--model", default=DEFAULT_MODEL, help="Gemini model (e.g., gemini-2.5-flash)")
     ap.add_argument("--rows", default="first", choices=["first","all"], help="'first' = only row 2 (first data row), 'all' = every row")
-    ap.add_argument("--sleep", type=float, default=1.0, help="Seconds to sleep after each API call")
+    ap.add_argument("--sleep", type=float, default=1.0, help="Base seconds between API call starts, shared by all calls (grows on 429s)")
+    ap.add_argument("--concurrency", type=int, default=8, help="Number of prompts in flight at once")
+    ap.add_argument("--overwrite", action="store_true", help="Start a fresh output instead of resuming it")
     args = ap.parse_args()
 
     require_key()
+    model = genai.GenerativeModel(args.model)  # built once, shared by all calls
     rows_in = read_csv_rows(args.input)
     if not rows_in:
         print("No data rows found.", file=sys.stderr); sys.exit(3)
@@ -112,45 +231,59 @@ def main():
     print(f"Loaded {len(rows_in)} items from {args.input}")
     print(f"Provider: gemini, Model: {args.model}, Mode: {args.rows}\n")
 
-    out_rows: List[Dict[str, str]] = []
+    if not args.overwrite:
+        dropped = drop_failed_rows(args.output)
+        if dropped:
+            print(f"Dropped {dropped} failed rows from {args.output}; they will be retried\n")
+    done = set() if args.overwrite else load_done_keys(args.output)
+    done_here = sum(1 for key in done if key[0] == args.model)
+    if done_here:
+        print(f"Resuming {args.output}: {done_here} {args.model} responses already written\n")
+
+    tasks = []
     for (visual_idx, row) in selected:
-        name = row.get("name","")
-        cat = row.get("category","")
-        no_title = row.get("norwegian_title","")
-        no_url = row.get("norwegian_url","")
         prompts = ensure_prompts(row)
+        print(f"[row {visual_idx}] {row.get('name','')} → {row.get('norwegian_title','')} ({len(prompts)} prompts)")
+        for j, p in enumerate(prompts, start=1):
+            if done_key(args.model, row, f"p{j}") not in done:
+                tasks.append((visual_idx, row, j, len(prompts), p))
 
-        print(f"[row {visual_idx}] {name} → {no_title} ({len(prompts)} prompts)")
-        if not prompts:
-            continue
+    limiter = RateLimiter(args.sleep)
+    sem = asyncio.Semaphore(args.concurrency)
+    async def run(task) -> Tuple[tuple, Dict[str, str]]:
+        async with sem:
+            return task, await call_gemini_safe(task[-1], model, limiter)
 
-        for j, p in enumerate(prompts, start=1):
-            print(f"  {j}/{len(prompts)} sending … ", end="", flush=True)
-            res = call_gemini_safe(p, args.model)
+    with contextlib.ExitStack() as stack:
+        # append even when nothing is done yet: the file may hold other models' rows
+        f, w = open_results_csv(stack, args.output, append=not args.overwrite)
+        # rows land in completion order; resume keys on (model, name, category, prompt_id), not position
+        for fut in asyncio.as_completed([run(t) for t in tasks]):
+            (visual_idx, row, j, n, p), res = await fut
+            prefix = f"  [row {visual_idx}] {j}/{n}"
             preview = (res['response_text'] or "[EMPTY]")[:80].replace("\n"," ")
             if res["error"]:
-                print(f"ERROR -> {res['error']}")
+                print(f"{prefix} ERROR -> {res['error']}")
             else:
-                print(f"ok -> {preview} ...")
-
-            out_rows.append({
-                "timestamp_utc": utc_now_iso(),
-                "provider": "gemini",
-                "model": args.model,
-                "row_index": str(visual_idx),
-                "name": name,
-                "category": cat,
-                "norwegian_title": no_title,
-                "norwegian_url": no_url,
-                "prompt_id": f"p{j}",
-                "prompt_text": p,
-                "response_text": res["response_text"],
-                "error": res["error"]
-            })
-            time.sleep(args.sleep)
-
-    write_results_csv(args.output, out_rows)
+                print(f"{prefix} ok -> {preview} ...")
+
+            w.writerow((  # same order as FIELDNAMES
+                utc_now_iso(),
+                "gemini",
+                args.model,
+                str(visual_idx),
+                row.get("name",""),
+                row.get("category",""),
+                row.get("norwegian_title",""),
+                row.get("norwegian_url",""),
+                f"p{j}",
+                p,
+                res["response_text"],
+                res["error"],
+            ))
+            f.flush()  # every response is on disk before the next one
+
     print(f"\nSaved → {args.output}")
 
 if __name__ == "__main__":
-    main()
+    (uvloop.run if uvloop else asyncio.run)(main())
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
-import os, csv, argparse, time, datetime, sys, traceback
-from typing import List, Dict, Any, Optional
-from openai import OpenAI
+import os, csv, argparse, asyncio, contextlib, time, datetime, sys, traceback, random
+from typing import List, Dict, Any, Optional, IO, Set, Tuple
+from openai import AsyncOpenAI
 from openai import APIStatusError, RateLimitError, APIError
+try:
+    import uvloop  # optional: faster event loop
+except ImportError:
+    uvloop = None
 
 # -------------------------
 # Config / Defaults
@@ -10,9 +14,14 @@ from openai import APIStatusError, RateLimitError, APIError
 DEFAULT_MODEL = "gpt-5"          # set to a chat-capable model you have access to
 CSV_OUT_DELIMITER = ";"          # Excel (Nordic) friendly
 MAX_TOKENS = 600
-SLEEP_BETWEEN_CALLS = 1.0        # be friendly to rate limits
+SLEEP_BETWEEN_CALLS = 1.0        # base spacing of call starts, shared by all calls
+CONCURRENCY = 8                  # prompts in flight at once
 RETRIES = 3
 RETRY_BACKOFF = 2.0              # exponential backoff base
+RATE_GROWTH = 0.2                # each success after a slowdown speeds calls up by this fraction
+RATE_SNAP = 0.05                 # seconds; closer than this to the base interval counts as recovered
+MIN_BACKOFF_INTERVAL = 0.5       # spacing after the first 429 even with --sleep 0
+MAX_INTERVAL = 60.0              # never space calls further apart than this
 
 SYSTEM_NO = (
     "Du er nøytral og faktabasert. "
@@ -23,56 +32,160 @@ SYSTEM_NO = (
 # -------------------------
 # CSV helpers
 # -------------------------
-def detect_delimiter(csv_path: str) -> str:
-    with open(csv_path, "r", encoding="utf-8-sig") as f:
-        head = f.readline()
-    # prefer ; when ties (Nordic Excel)
-    return ";" if head.count(";") >= head.count(",") else ","
-
 def read_csv_rows(csv_path: str) -> List[Dict[str, str]]:
-    delim = detect_delimiter(csv_path)
     with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        head = f.readline()
+        f.seek(0)
+        # prefer ; when ties (Nordic Excel)
+        delim = ";" if head.count(";") >= head.count(",") else ","
         return list(csv.DictReader(f, delimiter=delim))
 
-def write_results_csv(out_path: str, rows: List[Dict[str, str]]):
-    fieldnames = [
-        "timestamp_utc","provider","engine","model",
-        "row_index","name","category","norwegian_title","norwegian_url",
-        "prompt_id","prompt_text","response_text",
-        "prompt_tokens","completion_tokens","total_tokens","error"
-    ]
-    with open(out_path, "w", encoding="utf-8-sig", newline="") as f:
-        w = csv.DictWriter(
-            f, fieldnames=fieldnames,
-            delimiter=CSV_OUT_DELIMITER,
-            quoting=csv.QUOTE_ALL,
-            quotechar='"',
-            escapechar='\\'
-        )
-        w.writeheader()
-        w.writerows(rows)
+FIELDNAMES = [
+    "timestamp_utc","provider","engine","model",
+    "row_index","name","category","norwegian_title","norwegian_url",
+    "prompt_id","prompt_text","response_text",
+    "prompt_tokens","completion_tokens","total_tokens","error"
+]
+
+def is_failed(row: Dict[str, str]) -> bool:
+    text = row.get("response_text", "")
+    return bool(row.get("error")) or text == "[ERROR]" or text.startswith("ERROR:")
+
+def done_key(model: str, row: Dict[str, str], prompt_id: str) -> Tuple[str, str, str, str]:
+    # names repeat across categories in the inputs, so both identify a row
+    return (model, row.get("name",""), row.get("category",""), prompt_id)
+
+def load_done_keys(out_path: str) -> Set[Tuple[str, str, str, str]]:
+    """(model, name, category, prompt_id) keys a previous (possibly interrupted) run answered."""
+    if not os.path.exists(out_path):
+        return set()
+    with open(out_path, "r", encoding="utf-8-sig", newline="") as f:
+        r = csv.DictReader(f, delimiter=CSV_OUT_DELIMITER, quotechar='"', escapechar='\\')
+        return {
+            done_key(row.get("model",""), row, row.get("prompt_id",""))
+            for row in r if not is_failed(row)
+        }
+
+def results_writer(f: IO[str]) -> Any:
+    return csv.writer(
+        f,
+        delimiter=CSV_OUT_DELIMITER,
+        quoting=csv.QUOTE_ALL,
+        quotechar='"',
+        escapechar='\\'
+    )
+
+def drop_failed_rows(out_path: str) -> int:
+    """
+    Remove failed rows from a previous run's output before resuming, so the retry
+    that replaces each one is the only row left for its key. Returns how many went.
+    """
+    if not os.path.exists(out_path):
+        return 0
+    with open(out_path, "r", encoding="utf-8-sig", newline="") as f:
+        r = csv.reader(f, delimiter=CSV_OUT_DELIMITER, quotechar='"', escapechar='\\')
+        header = next(r, None)
+        rows = list(r)
+    if header is None:
+        return 0
+    kept = [row for row in rows if not is_failed(dict(zip(header, row)))]
+    if len(kept) == len(rows):
+        return 0
+    # write aside and swap, so an interruption here can't lose answered rows
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+        w = results_writer(f)
+        w.writerow(header)
+        w.writerows(kept)
+    os.replace(tmp_path, out_path)
+    return len(rows) - len(kept)
+
+def open_results_csv(stack: contextlib.ExitStack, out_path: str, append: bool) -> Tuple[IO[str], Any]:
+    """Positional csv.writer: callers write tuples in FIELDNAMES order."""
+    f = stack.enter_context(open(out_path, "a" if append else "w", encoding="utf-8-sig", newline=""))
+    w = results_writer(f)
+    if f.tell() == 0:
+        w.writerow(FIELDNAMES)
+    return f, w
 
 def ensure_prompts(row: Dict[str, str]) -> List[str]:
     prompts = [row.get("prompt_1",""), row.get("prompt_2",""), row.get("prompt_3","")]
     return [p.strip() for p in prompts if p and p.strip()]
 
+_LAST_TS = (0, "")  # (unix second, its ISO string)
+
 def utc_now_iso() -> str:
-    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+    """Second-resolution UTC timestamp, formatted at most once per second."""
+    global _LAST_TS
+    t = int(time.time())
+    sec, iso = _LAST_TS
+    if t != sec:
+        iso = datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc).isoformat()
+        _LAST_TS = (t, iso)
+    return iso
 
 def print_progress(prefix: str, status: str):
     print(f"{prefix} {status}", flush=True)
 
+class RateLimiter:
+    """
+    One call budget shared by all in-flight calls. Call starts are spaced `interval`
+    seconds apart; a rate-limit response halves the call rate, and each success
+    divides the interval by 1 + RATE_GROWTH (a multiplicative increase) until it is
+    within RATE_SNAP of the base interval, so a slowdown is undone within a couple
+    dozen calls at any rate.
+    Methods run on the event loop, so the bookkeeping needs no lock.
+    """
+    def __init__(self, interval: float):
+        self.base_interval = interval
+        self.interval = interval
+        self._next = 0.0
+        self._last_cut = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def on_success(self):
+        if self.interval > self.base_interval:
+            self.interval /= 1.0 + RATE_GROWTH
+            if self.interval - self.base_interval < RATE_SNAP:
+                self.interval = self.base_interval
+
+    def on_rate_limited(self):
+        now = time.monotonic()
+        # calls that were already in flight report the same 429 burst; cut once
+        if now - self._last_cut < self.interval:
+            return
+        self._last_cut = now
+        self.interval = min(max(self.interval * 2, MIN_BACKOFF_INTERVAL), MAX_INTERVAL)
+
 # -------------------------
 # OpenAI chat call with retries
 # -------------------------
-def call_openai_chat_with_retries(client: OpenAI, model: str, prompt: str) -> Dict[str, str]:
+def retry_after_seconds(e: APIStatusError, default: float) -> float:
+    """Server's retry hint (retry-after-ms / retry-after headers, capped at MAX_INTERVAL), else `default`."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return min(float(headers["retry-after-ms"]) / 1000.0, MAX_INTERVAL)
+        return min(float(headers.get("retry-after", default)), MAX_INTERVAL)
+    except (TypeError, ValueError):  # HTTP-date form; fall back to our own backoff
+        return default
+
+async def call_openai_chat_with_retries(client: AsyncOpenAI, model: str, prompt: str, limiter: RateLimiter) -> Dict[str, str]:
     """
     Robust chat call with retries; always returns a dict with response_text and token usage if present.
     """
     last_err = ""
     for attempt in range(1, RETRIES+1):
+        wait = RETRY_BACKOFF ** (attempt-1)
+        await limiter.wait()
         try:
-            r = client.chat.completions.create(
+            r = await client.chat.completions.create(
                 model=model,
                 messages=[
                     {"role": "system", "content": SYSTEM_NO},
@@ -80,6 +193,7 @@ def call_openai_chat_with_retries(client: OpenAI, model: str, prompt: str) -> Di
                 ],
                 max_completion_tokens=MAX_TOKENS,
             )
+            limiter.on_success()
             msg = r.choices[0].message
             text = (msg.content or "").strip()
             usage = getattr(r, "usage", None)
@@ -90,12 +204,17 @@ def call_openai_chat_with_retries(client: OpenAI, model: str, prompt: str) -> Di
                 "total_tokens": getattr(usage, "total_tokens", ""),
                 "error": ""
             }
-        except (RateLimitError, APIStatusError, APIError) as e:
+        except RateLimitError as e:
+            limiter.on_rate_limited()
+            last_err = f"{type(e).__name__}: {e}"
+            wait = retry_after_seconds(e, wait)
+        except (APIStatusError, APIError) as e:
             last_err = f"{type(e).__name__}: {e}"
         except Exception as e:
             last_err = f"{type(e).__name__}: {e}"
-        # backoff + retry
-        time.sleep(RETRY_BACKOFF ** (attempt-1))
+        # backoff + retry; jitter keeps concurrent calls from retrying in lockstep
+        if attempt < RETRIES:
+            await asyncio.sleep(wait + random.uniform(0, 0.5))
     # give up
     return {
         "response_text": "[ERROR]",
@@ -108,20 +227,22 @@ def call_openai_chat_with_retries(client: OpenAI, model: str, prompt: str) -> Di
 # -------------------------
 # Main
 # -------------------------
-def main():
+async def main():
     ap = argparse.ArgumentParser(description="Run 3 Norwegian prompts (from CSV) against OpenAI Chat Completions.")
     ap.add_argument("--input", required=True, help="Path to religious_ideology_no.csv")
     ap.add_argument("--output", default="religious_ideology_gpt5_responses.csv", help="Output CSV (semicolon, UTF-8 BOM)")
     ap.add_argument("--rows", default="first", choices=["first","all"], help="'first' = only row 2 (first data row). 'all' = every row.")
     ap.add_argument("--model", default=DEFAULT_MODEL, help="OpenAI chat-capable model, e.g., gpt-5 or gpt-5-thinking")
-    ap.add_argument("--sleep", type=float, default=SLEEP_BETWEEN_CALLS, help="Seconds to sleep between calls")
+    ap.add_argument("--sleep", type=float, default=SLEEP_BETWEEN_CALLS, help="Base seconds between call starts, shared by all calls (grows on 429s)")
+    ap.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Number of prompts in flight at once")
+    ap.add_argument("--overwrite", action="store_true", help="Start a fresh output instead of resuming it")
     args = ap.parse_args()
 
     if not os.environ.get("OPENAI_API_KEY"):
         print("ERROR: Please set OPENAI_API_KEY in your environment.", file=sys.stderr)
         sys.exit(2)
 
-    client = OpenAI()  # reads OPENAI_API_KEY
+    client = AsyncOpenAI()  # reads OPENAI_API_KEY
     rows_in = read_csv_rows(args.input)
     if not rows_in:
         print("No data rows in input CSV.", file=sys.stderr)
@@ -136,51 +257,66 @@ def main():
     print(f"Loaded {len(rows_in)} items from {args.input}")
     print(f"Mode: {args.rows}, Model: {args.model}\n")
 
-    out_rows: List[Dict[str, str]] = []
+    if not args.overwrite:
+        dropped = drop_failed_rows(args.output)
+        if dropped:
+            print(f"Dropped {dropped} failed rows from {args.output}; they will be retried\n")
+    done = set() if args.overwrite else load_done_keys(args.output)
+    done_here = sum(1 for key in done if key[0] == args.model)
+    if done_here:
+        print(f"Resuming {args.output}: {done_here} {args.model} responses already written\n")
 
+    tasks = []
     for (visual_idx, row) in selected:
-        name = row.get("name","")
-        cat = row.get("category","")
-        no_title = row.get("norwegian_title","")
-        no_url = row.get("norwegian_url","")
         prompts = ensure_prompts(row)
-
-        print_progress(f"[row {visual_idx}] {name} → {no_title}", f"({len(prompts)} prompts)")
+        print_progress(f"[row {visual_idx}] {row.get('name','')} → {row.get('norwegian_title','')}", f"({len(prompts)} prompts)")
         if not prompts:
             print_progress("  0/0", "no prompts in row")
-            continue
-
         for j, p in enumerate(prompts, start=1):
-            prefix = f"  {j}/{len(prompts)}"
-            resp = call_openai_chat_with_retries(client, args.model, p)
-            preview = (resp["response_text"] or "[EMPTY]")[:80].replace("\n"," ")
-            if resp["error"]:
-                print_progress(prefix, f"ERROR -> {resp['error']}")
-            else:
-                print_progress(prefix, f"ok -> {preview} ...")
-
-            out_rows.append({
-                "timestamp_utc": utc_now_iso(),
-                "provider": "openai",
-                "engine": "chat",
-                "model": args.model,
-                "row_index": str(visual_idx),
-                "name": name,
-                "category": cat,
-                "norwegian_title": no_title,
-                "norwegian_url": no_url,
-                "prompt_id": f"p{j}",
-                "prompt_text": p,
-                "response_text": resp["response_text"],
-                "prompt_tokens": resp["prompt_tokens"],
-                "completion_tokens": resp["completion_tokens"],
-                "total_tokens": resp["total_tokens"],
-                "error": resp["error"],
-            })
-            time.sleep(args.sleep)
-
-    write_results_csv(args.output, out_rows)
+            if done_key(args.model, row, f"p{j}") not in done:
+                tasks.append((visual_idx, row, j, len(prompts), p))
+
+    limiter = RateLimiter(args.sleep)
+    sem = asyncio.Semaphore(args.concurrency)
+    async def run(task) -> Tuple[tuple, Dict[str, str]]:
+        async with sem:
+            return task, await call_openai_chat_with_retries(client, args.model, task[-1], limiter)
+
+    async with client:  # closes the HTTP connection pool on the way out
+        with contextlib.ExitStack() as stack:
+            # append even when nothing is done yet: the file may hold other models' rows
+            f, w = open_results_csv(stack, args.output, append=not args.overwrite)
+            # rows land in completion order; resume keys on (model, name, category, prompt_id), not position
+            for fut in asyncio.as_completed([run(t) for t in tasks]):
+                (visual_idx, row, j, n, p), resp = await fut
+                prefix = f"  [row {visual_idx}] {j}/{n}"
+                preview = (resp["response_text"] or "[EMPTY]")[:80].replace("\n"," ")
+                if resp["error"]:
+                    print_progress(prefix, f"ERROR -> {resp['error']}")
+                else:
+                    print_progress(prefix, f"ok -> {preview} ...")
+
+                w.writerow((  # same order as FIELDNAMES
+                    utc_now_iso(),
+                    "openai",
+                    "chat",
+                    args.model,
+                    str(visual_idx),
+                    row.get("name",""),
+                    row.get("category",""),
+                    row.get("norwegian_title",""),
+                    row.get("norwegian_url",""),
+                    f"p{j}",
+                    p,
+                    resp["response_text"],
+                    resp["prompt_tokens"],
+                    resp["completion_tokens"],
+                    resp["total_tokens"],
+                    resp["error"],
+                ))
+                f.flush()  # every response is on disk before the next one
+
     print(f"\nSaved → {args.output}")
 
 if __name__ == "__main__":
-    main()
+    (uvloop.run if uvloop else asyncio.run)(main())